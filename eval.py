@@ -22,7 +22,6 @@ from absl import app
 from absl import flags
 import flax
 from flax.metrics import tensorboard
-from flax.training import checkpoints
 import jax
 from jax import random
 import numpy as np
@@ -62,27 +61,31 @@ def main(unused_argv):
     raise ValueError("train_dir must be set. None set now.")
   if FLAGS.data_dir is None:
     raise ValueError("data_dir must be set. None set now.")
+  utils.initialize_compilation_cache(FLAGS.train_dir)
 
   dataset = datasets.get_dataset("test", FLAGS)
   rng, key = random.split(rng)
   model, init_variables = models.get_model(key, dataset.peek(), FLAGS)
   optimizer = flax.optim.Adam(FLAGS.lr_init).create(init_variables)
-  state = utils.TrainState(optimizer=optimizer)
+  state = utils.TrainState(
+      optimizer=optimizer, density_grid=utils.init_density_grid(FLAGS))
   del optimizer, init_variables
 
   lpips_model = tf_hub.load(LPIPS_TFHUB_PATH)
 
   # Rendering is forced to be deterministic even if training was randomized, as
   # this eliminates "speckle" artifacts.
-  def render_fn(variables, key_0, key_1, rays):
+  def render_fn(variables, density_grid, key_0, key_1, rays):
     return jax.lax.all_gather(
-        model.apply(variables, key_0, key_1, rays, False), axis_name="batch")
+        model.apply(variables, key_0, key_1, rays, False, density_grid),
+        axis_name="batch")
 
-  # pmap over only the data input.
+  # The variables and density grid are replicated once per checkpoint, so only
+  # the data input is transferred for every chunk.
   render_pfn = jax.pmap(
       render_fn,
-      in_axes=(None, None, None, 0),
-      donate_argnums=3,
+      in_axes=(0, 0, None, None, 0),
+      donate_argnums=4,
       axis_name="batch",
   )
 
@@ -97,12 +100,14 @@ def main(unused_argv):
     summary_writer = tensorboard.SummaryWriter(
         path.join(FLAGS.train_dir, "eval"))
   while True:
-    state = checkpoints.restore_checkpoint(FLAGS.train_dir, state)
+    state = utils.restore_checkpoint(FLAGS.train_dir, state)
     step = int(state.optimizer.state.step)
     if step <= last_step:
       continue
     if FLAGS.save_output and (not utils.isdir(out_dir)):
       utils.makedirs(out_dir)
+    render_variables = flax.jax_utils.replicate(state.optimizer.target)
+    render_density_grid = flax.jax_utils.replicate(state.density_grid)
     psnr_values = []
     ssim_values = []
     lpips_values = []
@@ -112,7 +117,8 @@ def main(unused_argv):
       print(f"Evaluating {idx+1}/{dataset.size}")
       batch = next(dataset)
       pred_color, pred_disp, pred_acc = utils.render_image(
-          functools.partial(render_pfn, state.optimizer.target),
+          functools.partial(render_pfn, render_variables,
+                            render_density_grid),
           batch["rays"],
           rng,
           FLAGS.dataset == "llff",
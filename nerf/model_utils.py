@@ -24,6 +24,7 @@ import jax
 from jax import lax
 from jax import random
 import jax.numpy as jnp
+import numpy as np
 
 
 class MLP(nn.Module):
@@ -36,9 +37,10 @@ class MLP(nn.Module):
   skip_layer: int = 4  # The layer to add skip layers to.
   num_rgb_channels: int = 3  # The number of RGB channels.
   num_sigma_channels: int = 1  # The number of sigma channels.
+  dtype: Any = jnp.float32  # The dtype of the computation (params stay fp32).
 
   @nn.compact
-  def __call__(self, x, condition=None):
+  def __call__(self, x, condition=None, density_only=False):
     """Evaluate the MLP.
 
     Args:
@@ -48,18 +50,25 @@ class MLP(nn.Module):
         concatenated with the output vector of the first part of the MLP. If
         None, only the first part of the MLP will be used with input x. In the
         original paper, this variable is the view direction.
+      density_only: bool, if True, only evaluate the layers leading to sigma
+        and return it alone.
 
     Returns:
       raw_rgb: jnp.ndarray(float32), with a shape of
            [batch, num_samples, num_rgb_channels].
       raw_sigma: jnp.ndarray(float32), with a shape of
            [batch, num_samples, num_sigma_channels].
+
+    Regardless of `dtype`, the outputs are cast back to float32 as they feed
+    into numerically sensitive activations and volumetric rendering.
     """
     feature_dim = x.shape[-1]
     num_samples = x.shape[1]
-    x = x.reshape([-1, feature_dim])
+    x = x.reshape([-1, feature_dim]).astype(self.dtype)
     dense_layer = functools.partial(
-        nn.Dense, kernel_init=jax.nn.initializers.glorot_uniform())
+        nn.Dense,
+        dtype=self.dtype,
+        kernel_init=jax.nn.initializers.glorot_uniform())
     inputs = x
     for i in range(self.net_depth):
       x = dense_layer(self.net_width)(x)
@@ -67,25 +76,34 @@ class MLP(nn.Module):
       if i % self.skip_layer == 0 and i > 0:
         x = jnp.concatenate([x, inputs], axis=-1)
     raw_sigma = dense_layer(self.num_sigma_channels)(x).reshape(
-        [-1, num_samples, self.num_sigma_channels])
+        [-1, num_samples, self.num_sigma_channels]).astype(jnp.float32)
+    if density_only:
+      return raw_sigma
 
     if condition is not None:
       # Output of the first part of MLP.
-      bottleneck = dense_layer(self.net_width)(x)
-      # Broadcast condition from [batch, feature] to
+      bottleneck = dense_layer(self.net_width)(x).reshape(
+          [-1, num_samples, self.net_width])
+      # Broadcast condition from [batch, 1, feature] to
       # [batch, num_samples, feature] since all the samples along the same ray
-      # have the same viewdir.
-      condition = jnp.tile(condition[:, None, :], (1, num_samples, 1))
+      # have the same viewdir. The broadcast is fused into the concatenation
+      # rather than materializing a tiled copy of `condition`.
+      condition = condition[:, None, :].astype(self.dtype)
+      x = jnp.concatenate([
+          bottleneck,
+          jnp.broadcast_to(condition, bottleneck.shape[:-1] +
+                           condition.shape[-1:])
+      ],
+                          axis=-1)
       # Collapse the [batch, num_samples, feature] tensor to
       # [batch * num_samples, feature] so that it can be fed into nn.Dense.
-      condition = condition.reshape([-1, condition.shape[-1]])
-      x = jnp.concatenate([bottleneck, condition], axis=-1)
+      x = x.reshape([-1, x.shape[-1]])
       # Here use 1 extra layer to align with the original nerf model.
       for i in range(self.net_depth_condition):
         x = dense_layer(self.net_width_condition)(x)
         x = self.net_activation(x)
     raw_rgb = dense_layer(self.num_rgb_channels)(x).reshape(
-        [-1, num_samples, self.num_rgb_channels])
+        [-1, num_samples, self.num_rgb_channels]).astype(jnp.float32)
     return raw_rgb, raw_sigma
 
 
@@ -133,6 +151,12 @@ def sample_along_rays(key, origins, directions, num_samples, near, far,
   return z_vals, coords
 
 
+@functools.lru_cache(maxsize=None)
+def _posenc_scales(min_deg, max_deg):
+  """Cached frequency bands 2^[min_deg, max_deg-1] as a host-side constant."""
+  return np.array([2.**i for i in range(min_deg, max_deg)], dtype=np.float32)
+
+
 def posenc(x, min_deg, max_deg, legacy_posenc_order=False):
   """Cat x with a positional encoding of x with scales 2^[min_deg, max_deg-1].
 
@@ -150,7 +174,7 @@ def posenc(x, min_deg, max_deg, legacy_posenc_order=False):
   """
   if min_deg == max_deg:
     return x
-  scales = jnp.array([2**i for i in range(min_deg, max_deg)])
+  scales = _posenc_scales(min_deg, max_deg)
   if legacy_posenc_order:
     xb = x[Ellipsis, None, :] * scales[:, None]
     four_feat = jnp.reshape(
@@ -163,7 +187,7 @@ def posenc(x, min_deg, max_deg, legacy_posenc_order=False):
   return jnp.concatenate([x] + [four_feat], axis=-1)
 
 
-def volumetric_rendering(rgb, sigma, z_vals, dirs, white_bkgd):
+def volumetric_rendering(rgb, sigma, z_vals, dirs, white_bkgd, dists=None):
   """Volumetric Rendering Function.
 
   Args:
@@ -172,6 +196,9 @@ def volumetric_rendering(rgb, sigma, z_vals, dirs, white_bkgd):
     z_vals: jnp.ndarray(float32), [batch_size, num_samples].
     dirs: jnp.ndarray(float32), [batch_size, 3].
     white_bkgd: bool.
+    dists: jnp.ndarray(float32), [batch_size, num_samples], if not None, the
+      length of the interval of each sample, instead of the distance to the
+      next sample.
 
   Returns:
     comp_rgb: jnp.ndarray(float32), [batch_size, 3].
@@ -180,19 +207,24 @@ def volumetric_rendering(rgb, sigma, z_vals, dirs, white_bkgd):
     weights: jnp.ndarray(float32), [batch_size, num_samples]
   """
   eps = 1e-10
-  dists = jnp.concatenate([
-      z_vals[Ellipsis, 1:] - z_vals[Ellipsis, :-1],
-      jnp.broadcast_to([1e10], z_vals[Ellipsis, :1].shape)
-  ], -1)
+  if dists is None:
+    dists = jnp.concatenate([
+        z_vals[Ellipsis, 1:] - z_vals[Ellipsis, :-1],
+        jnp.broadcast_to([1e10], z_vals[Ellipsis, :1].shape)
+    ], -1)
   dists = dists * jnp.linalg.norm(dirs[Ellipsis, None, :], axis=-1)
   # Note that we're quietly turning sigma from [..., 0] to [...].
-  alpha = 1.0 - jnp.exp(-sigma[Ellipsis, 0] * dists)
-  accum_prod = jnp.concatenate([
-      jnp.ones_like(alpha[Ellipsis, :1], alpha.dtype),
-      jnp.cumprod(1.0 - alpha[Ellipsis, :-1] + eps, axis=-1)
+  density_delta = sigma[Ellipsis, 0] * dists
+  alpha = 1.0 - jnp.exp(-density_delta)
+  # The transmittance prod(1 - alpha) over the preceding samples is computed as
+  # exp(-exclusive_cumsum(sigma * delta)), which shares `density_delta` with
+  # `alpha` and replaces a cumprod (and its costly gradient) with a cumsum.
+  trans = jnp.exp(-jnp.concatenate([
+      jnp.zeros_like(density_delta[Ellipsis, :1]),
+      jnp.cumsum(density_delta[Ellipsis, :-1], axis=-1)
   ],
-                               axis=-1)
-  weights = alpha * accum_prod
+                                   axis=-1))
+  weights = alpha * trans
 
   comp_rgb = (weights[Ellipsis, None] * rgb).sum(axis=-2)
   depth = (weights * z_vals).sum(axis=-1)
@@ -248,14 +280,17 @@ def piecewise_constant_pdf(key, bins, weights, num_samples, randomized):
     u = jnp.broadcast_to(u, list(cdf.shape[:-1]) + [num_samples])
 
   # Identify the location in `cdf` that corresponds to a random sample.
-  # The final `True` index in `mask` will be the start of the sampled interval.
-  mask = u[Ellipsis, None, :] >= cdf[Ellipsis, :, None]
+  # Because `cdf` is sorted, the number of its entries that are <= `u` is the
+  # index of the end of the sampled interval. This is a single branchless
+  # reduction over a broadcasted comparison, followed by cheap gathers.
+  idx = jnp.sum(u[Ellipsis, None, :] >= cdf[Ellipsis, :, None], axis=-2)
+  idx_below = jnp.maximum(idx - 1, 0)
+  idx_above = jnp.minimum(idx, cdf.shape[-1] - 1)
 
   def find_interval(x):
-    # Grab the value where `mask` switches from True to False, and vice versa.
-    # This approach takes advantage of the fact that `x` is sorted.
-    x0 = jnp.max(jnp.where(mask, x[Ellipsis, None], x[Ellipsis, :1, None]), -2)
-    x1 = jnp.min(jnp.where(~mask, x[Ellipsis, None], x[Ellipsis, -1:, None]), -2)
+    # Grab the values at both ends of the sampled interval.
+    x0 = jnp.take_along_axis(x, idx_below, axis=-1)
+    x1 = jnp.take_along_axis(x, idx_above, axis=-1)
     return x0, x1
 
   bins_g0, bins_g1 = find_interval(bins)
@@ -296,6 +331,158 @@ def sample_pdf(key, bins, weights, origins, directions, z_vals, num_samples,
   return z_vals, coords
 
 
+def density_grid_indices(points, resolution, bound):
+  """Map points to the flattened cells of a density grid.
+
+  Args:
+    points: jnp.ndarray(float32), [..., 3], query points.
+    resolution: int, the number of cells along each side of the grid.
+    bound: float, the grid covers the cube [-bound, bound]^3.
+
+  Returns:
+    indices: jnp.ndarray(int32), [...], flattened (clipped) cell indices.
+    inside: jnp.ndarray(bool), [...], True if the point lies inside the grid.
+  """
+  ijk = jnp.floor((points + bound) / (2. * bound) * resolution).astype(
+      jnp.int32)
+  inside = jnp.all((ijk >= 0) & (ijk < resolution), axis=-1)
+  ijk = jnp.clip(ijk, 0, resolution - 1)
+  indices = ((ijk[Ellipsis, 0] * resolution + ijk[Ellipsis, 1]) * resolution +
+             ijk[Ellipsis, 2])
+  return indices, inside
+
+
+def occupied(density_grid, points, bound, threshold):
+  """Look up whether points fall in occupied cells of a density grid.
+
+  Points outside of the grid are conservatively treated as occupied.
+
+  Args:
+    density_grid: jnp.ndarray(float32), [res, res, res], density estimates.
+    points: jnp.ndarray(float32), [..., 3], query points.
+    bound: float, the grid covers the cube [-bound, bound]^3.
+    threshold: float, cells with a density above `threshold` are occupied.
+
+  Returns:
+    occupied: jnp.ndarray(bool), [...].
+  """
+  indices, inside = density_grid_indices(points, density_grid.shape[0], bound)
+  return (density_grid.reshape([-1])[indices] > threshold) | ~inside
+
+
+def pack_occupied(z_vals, occupancy, num_samples):
+  """Pack the occupied samples along the rays into a smaller static buffer.
+
+  The samples keep their stratified positions. If a ray has more than
+  `num_samples` occupied samples, evenly spaced ones (by rank) are kept and
+  their intervals are widened to cover the ones that were dropped.
+
+  Args:
+    z_vals: jnp.ndarray(float32), [batch_size, num_candidates], sorted samples.
+    occupancy: jnp.ndarray(bool), [batch_size, num_candidates], whether each
+      sample lies in an occupied cell.
+    num_samples: int, the maximum number of samples kept per ray.
+
+  Returns:
+    z_vals: jnp.ndarray(float32), [batch_size, num_samples], packed samples.
+    dists: jnp.ndarray(float32), [batch_size, num_samples], the length of the
+      interval along the ray represented by each packed sample.
+    valid: jnp.ndarray(bool), [batch_size, num_samples], False for the padding
+      slots of rays with fewer than `num_samples` occupied samples.
+    indices: jnp.ndarray(int32), [batch_size, num_samples], the index of each
+      packed sample in the input.
+  """
+  num_candidates = z_vals.shape[-1]
+  count = jnp.cumsum(occupancy.astype(jnp.int32), axis=-1)
+  num_occupied = count[Ellipsis, -1:]
+  stride = jnp.maximum(num_occupied, num_samples)
+  # The rank among the occupied samples of the sample packed in each slot.
+  rank = jnp.arange(num_samples) * stride // num_samples
+  valid = rank < num_occupied
+  # The number of samples with fewer than `rank + 1` occupied samples up to and
+  # including them is the index of the occupied sample of that rank.
+  indices = jnp.minimum(
+      jnp.sum(count[Ellipsis, None, :] <= rank[Ellipsis, :, None], axis=-1),
+      num_candidates - 1)
+  dists = jnp.concatenate([
+      z_vals[Ellipsis, 1:] - z_vals[Ellipsis, :-1],
+      jnp.full_like(z_vals[Ellipsis, :1], 1e10)
+  ], -1)
+  dists = jnp.take_along_axis(dists, indices, axis=-1) * (
+      stride / num_samples)
+  z_vals = jnp.take_along_axis(z_vals, indices, axis=-1)
+  return z_vals, dists, valid, indices
+
+
+def unpack_occupied(values, valid, indices, num_candidates):
+  """Scatter per-sample values of `pack_occupied` back to the input samples.
+
+  Args:
+    values: jnp.ndarray(float32), [batch_size, num_samples], packed values.
+    valid: jnp.ndarray(bool), [batch_size, num_samples], valid packed samples.
+    indices: jnp.ndarray(int32), [batch_size, num_samples], the index of each
+      packed sample in the input.
+    num_candidates: int, the number of samples of the input.
+
+  Returns:
+    values: jnp.ndarray(float32), [batch_size, num_candidates], the values of
+      the packed samples, and zeros elsewhere.
+  """
+  rows = jnp.arange(values.shape[0])[:, None]
+  return jnp.zeros([values.shape[0], num_candidates], values.dtype).at[
+      rows, indices].add(jnp.where(valid, values, 0.))
+
+
+def update_density_grid(key,
+                        density_fn,
+                        density_grid,
+                        bound,
+                        num_cells,
+                        decay=0.95,
+                        axis_name=None):
+  """Refresh the density estimates of a random subset of grid cells.
+
+  Each selected cell is queried at a random point inside of it, and keeps the
+  maximum of its decayed previous estimate and the new density.
+
+  Args:
+    key: jnp.ndarray(float32), [2,], random number generator.
+    density_fn: function, maps [num_points, 3] points to [num_points] densities.
+    density_grid: jnp.ndarray(float32), [res, res, res], density estimates.
+    bound: float, the grid covers the cube [-bound, bound]^3.
+    num_cells: int, the number of cells to update.
+    decay: float, the decay applied to the previous estimate of a cell.
+    axis_name: str, if not None, the cells are split evenly among the devices
+      of this pmapped axis, which must share `key`, and the densities are
+      gathered so that every replica of the grid receives the same update.
+
+  Returns:
+    density_grid: jnp.ndarray(float32), [res, res, res], updated estimates.
+  """
+  resolution = density_grid.shape[0]
+  key_0, key_1 = random.split(key)
+  indices = random.randint(key_0, [num_cells], 0, resolution**3)
+  ijk = jnp.stack([
+      indices // resolution**2, (indices // resolution) % resolution,
+      indices % resolution
+  ], -1)
+  jitter = random.uniform(key_1, [num_cells, 3])
+  points = (ijk + jitter) / resolution * (2. * bound) - bound
+  if axis_name is None:
+    sigma = density_fn(points)
+  else:
+    shard_size = num_cells // lax.psum(1, axis_name)
+    shard = lax.dynamic_slice_in_dim(points,
+                                     lax.axis_index(axis_name) * shard_size,
+                                     shard_size)
+    sigma = lax.all_gather(density_fn(shard), axis_name).reshape([-1])
+  sigma = lax.stop_gradient(sigma)
+  flat_grid = density_grid.reshape([-1])
+  flat_grid = flat_grid.at[indices].set(
+      jnp.maximum(flat_grid[indices] * decay, sigma))
+  return flat_grid.reshape(density_grid.shape)
+
+
 def add_gaussian_noise(key, raw, noise_std, randomized):
   """Adds gaussian noise to `raw`, which can used to regularize it.
 
@@ -15,14 +15,37 @@
 
 # Lint as: python3
 """Different model implementation plus a general port for all the models."""
+import functools
 from typing import Any, Callable
 from flax import linen as nn
+import jax
 from jax import random
 import jax.numpy as jnp
 
 from jaxnerf.nerf import model_utils
 from jaxnerf.nerf import utils
 
+# The names of the coarse and fine MLPs in the model's variables. They match
+# the names linen would generate, so existing checkpoints keep loading.
+COARSE_MLP_NAME = "MLP_0"
+FINE_MLP_NAME = "MLP_1"
+
+# Activations available to the model, mapped directly to the jax primitives.
+ACTIVATIONS = {
+    "relu": jax.nn.relu,
+    "elu": jax.nn.elu,
+    "gelu": jax.nn.gelu,
+    "silu": jax.nn.silu,
+    "swish": jax.nn.swish,
+    "tanh": jnp.tanh,
+    "sigmoid": jax.nn.sigmoid,
+    "softplus": jax.nn.softplus,
+}
+
+# Activations known to produce colors in [0, 1] and non-negative densities.
+RGB_ACTIVATIONS = ("sigmoid",)
+SIGMA_ACTIVATIONS = ("relu", "softplus")
+
 
 def get_model(key, example_batch, args):
   """A helper function that wraps around a 'model zoo'."""
@@ -56,9 +79,13 @@ class NerfModel(nn.Module):
   rgb_activation: Callable[Ellipsis, Any]  # Output RGB activation.
   sigma_activation: Callable[Ellipsis, Any]  # Output sigma activation.
   legacy_posenc_order: bool  # Keep the same ordering as the original tf code.
+  mlp_dtype: Any = jnp.float32  # The dtype of the MLP computation.
+  occupancy_bound: float = 1.5  # The density grid covers [-bound, bound]^3.
+  occupancy_threshold: float = 0.01  # The density of an occupied grid cell.
+  occupancy_max_samples: int = 32  # The max occupied coarse samples per ray.
 
   @nn.compact
-  def __call__(self, rng_0, rng_1, rays, randomized):
+  def __call__(self, rng_0, rng_1, rays, randomized, density_grid=None):
     """Nerf Model.
 
     Args:
@@ -66,6 +93,10 @@ class NerfModel(nn.Module):
       rng_1: jnp.ndarray, random number generator for fine model sampling.
       rays: util.Rays, a namedtuple of ray origins, directions, and viewdirs.
       randomized: bool, use randomized stratified sampling.
+      density_grid: jnp.ndarray(float32), [res, res, res], if not None, only
+        the coarse samples in occupied cells of this grid (at most
+        `occupancy_max_samples` per ray) are evaluated, and fine samples in
+        empty cells are given zero density.
 
     Returns:
       ret: list, [(rgb_coarse, disp_coarse, acc_coarse), (rgb, disp, acc)]
@@ -82,6 +113,17 @@ class NerfModel(nn.Module):
         randomized,
         self.lindisp,
     )
+    if density_grid is not None:
+      # Skip empty space by only evaluating the occupied coarse samples.
+      candidate_z_vals = z_vals
+      z_vals, dists, valid, indices = model_utils.pack_occupied(
+          z_vals,
+          self._occupied(density_grid, samples),
+          self.occupancy_max_samples,
+      )
+      samples = jnp.take_along_axis(samples, indices[Ellipsis, None], axis=-2)
+    else:
+      dists = None
     samples_enc = model_utils.posenc(
         samples,
         self.min_deg_point,
@@ -89,16 +131,12 @@ class NerfModel(nn.Module):
         self.legacy_posenc_order,
     )
 
+    # Both the "coarse" and the "fine" MLPs share the same configuration (but
+    # not the same parameters), so bind the hyperparameters once.
+    mlp_fn = functools.partial(model_utils.MLP, **mlp_kwargs(self))
+
     # Construct the "coarse" MLP.
-    coarse_mlp = model_utils.MLP(
-        net_depth=self.net_depth,
-        net_width=self.net_width,
-        net_depth_condition=self.net_depth_condition,
-        net_width_condition=self.net_width_condition,
-        net_activation=self.net_activation,
-        skip_layer=self.skip_layer,
-        num_rgb_channels=self.num_rgb_channels,
-        num_sigma_channels=self.num_sigma_channels)
+    coarse_mlp = mlp_fn(name=COARSE_MLP_NAME)
 
     # Point attribute predictions
     if self.use_viewdirs:
@@ -121,6 +159,8 @@ class NerfModel(nn.Module):
     )
     rgb = self.rgb_activation(raw_rgb)
     sigma = self.sigma_activation(raw_sigma)
+    if density_grid is not None:
+      sigma = jnp.where(valid[Ellipsis, None], sigma, 0.)
     # Volumetric rendering.
     comp_rgb, disp, acc, weights = model_utils.volumetric_rendering(
         rgb,
@@ -128,12 +168,19 @@ class NerfModel(nn.Module):
         z_vals,
         rays.directions,
         white_bkgd=self.white_bkgd,
+        dists=dists,
     )
     ret = [
         (comp_rgb, disp, acc),
     ]
     # Hierarchical sampling based on coarse predictions
     if self.num_fine_samples > 0:
+      if density_grid is not None:
+        # Resample from all the coarse samples, the skipped ones having zero
+        # weight.
+        weights = model_utils.unpack_occupied(weights, valid, indices,
+                                              candidate_z_vals.shape[-1])
+        z_vals = candidate_z_vals
       z_vals_mid = .5 * (z_vals[Ellipsis, 1:] + z_vals[Ellipsis, :-1])
       key, rng_1 = random.split(rng_1)
       z_vals, samples = model_utils.sample_pdf(
@@ -154,15 +201,7 @@ class NerfModel(nn.Module):
       )
 
       # Construct the "fine" MLP.
-      fine_mlp = model_utils.MLP(
-          net_depth=self.net_depth,
-          net_width=self.net_width,
-          net_depth_condition=self.net_depth_condition,
-          net_width_condition=self.net_width_condition,
-          net_activation=self.net_activation,
-          skip_layer=self.skip_layer,
-          num_rgb_channels=self.num_rgb_channels,
-          num_sigma_channels=self.num_sigma_channels)
+      fine_mlp = mlp_fn(name=FINE_MLP_NAME)
 
       if self.use_viewdirs:
         raw_rgb, raw_sigma = fine_mlp(samples_enc, viewdirs_enc)
@@ -177,6 +216,9 @@ class NerfModel(nn.Module):
       )
       rgb = self.rgb_activation(raw_rgb)
       sigma = self.sigma_activation(raw_sigma)
+      if density_grid is not None:
+        sigma = jnp.where(
+            self._occupied(density_grid, samples)[Ellipsis, None], sigma, 0.)
       comp_rgb, disp, acc, unused_weights = model_utils.volumetric_rendering(
           rgb,
           sigma,
@@ -187,6 +229,49 @@ class NerfModel(nn.Module):
       ret.append((comp_rgb, disp, acc))
     return ret
 
+  def _occupied(self, density_grid, samples):
+    return model_utils.occupied(density_grid, samples, self.occupancy_bound,
+                                self.occupancy_threshold)
+
+
+def mlp_kwargs(model):
+  """The configuration of the MLPs of `model`."""
+  return dict(
+      net_depth=model.net_depth,
+      net_width=model.net_width,
+      net_depth_condition=model.net_depth_condition,
+      net_width_condition=model.net_width_condition,
+      net_activation=model.net_activation,
+      skip_layer=model.skip_layer,
+      num_rgb_channels=model.num_rgb_channels,
+      num_sigma_channels=model.num_sigma_channels,
+      dtype=model.mlp_dtype)
+
+
+def query_density(model, variables, points):
+  """Evaluate the density predicted by the coarse MLP of `model`.
+
+  Args:
+    model: NerfModel, the model to query.
+    variables: the variables of `model`.
+    points: jnp.ndarray(float32), [num_points, 3], query points.
+
+  Returns:
+    sigma: jnp.ndarray(float32), [num_points], the predicted densities.
+  """
+  points_enc = model_utils.posenc(
+      points[:, None, :],
+      model.min_deg_point,
+      model.max_deg_point,
+      model.legacy_posenc_order,
+  )
+  coarse_mlp = model_utils.MLP(**mlp_kwargs(model))
+  coarse_variables = {"params": variables["params"][COARSE_MLP_NAME]}
+  # The density does not depend on the view direction, so only the trunk and
+  # the sigma head of the MLP are evaluated.
+  raw_sigma = coarse_mlp.apply(coarse_variables, points_enc, density_only=True)
+  return model.sigma_activation(raw_sigma)[:, 0, 0]
+
 
 def construct_nerf(key, example_batch, args):
   """Construct a Neural Radiance Field.
@@ -200,27 +285,33 @@ def construct_nerf(key, example_batch, args):
     model: nn.Model. Nerf model with parameters.
     state: flax.Module.state. Nerf model state for stateful parameters.
   """
-  net_activation = getattr(nn, str(args.net_activation))
-  rgb_activation = getattr(nn, str(args.rgb_activation))
-  sigma_activation = getattr(nn, str(args.sigma_activation))
+  if args.net_activation not in ACTIVATIONS:
+    raise NotImplementedError(
+        "Choice of net_activation `{}` is not supported".format(
+            args.net_activation))
 
   # Assert that rgb_activation always produces outputs in [0, 1], and
   # sigma_activation always produce non-negative outputs.
-  x = jnp.exp(jnp.linspace(-90, 90, 1024))
-  x = jnp.concatenate([-x[::-1], x], 0)
-
-  rgb = rgb_activation(x)
-  if jnp.any(rgb < 0) or jnp.any(rgb > 1):
+  if args.rgb_activation not in RGB_ACTIVATIONS:
     raise NotImplementedError(
         "Choice of rgb_activation `{}` produces colors outside of [0, 1]"
         .format(args.rgb_activation))
 
-  sigma = sigma_activation(x)
-  if jnp.any(sigma < 0):
+  if args.sigma_activation not in SIGMA_ACTIVATIONS:
     raise NotImplementedError(
         "Choice of sigma_activation `{}` produces negative densities".format(
             args.sigma_activation))
 
+  if (args.occupancy_grid_res > 0 and
+      not 0 < args.occupancy_max_samples <= args.num_coarse_samples):
+    raise ValueError(
+        "occupancy_max_samples must be in [1, num_coarse_samples], got {}"
+        .format(args.occupancy_max_samples))
+
+  net_activation = ACTIVATIONS[args.net_activation]
+  rgb_activation = ACTIVATIONS[args.rgb_activation]
+  sigma_activation = ACTIVATIONS[args.sigma_activation]
+
   model = NerfModel(
       min_deg_point=args.min_deg_point,
       max_deg_point=args.max_deg_point,
@@ -243,7 +334,11 @@ def construct_nerf(key, example_batch, args):
       net_activation=net_activation,
       rgb_activation=rgb_activation,
       sigma_activation=sigma_activation,
-      legacy_posenc_order=args.legacy_posenc_order)
+      legacy_posenc_order=args.legacy_posenc_order,
+      mlp_dtype=getattr(jnp, str(args.mlp_dtype)),
+      occupancy_bound=args.occupancy_bound,
+      occupancy_threshold=args.occupancy_threshold,
+      occupancy_max_samples=args.occupancy_max_samples)
   rays = example_batch["rays"]
   key1, key2, key3 = random.split(key, num=3)
 
@@ -18,8 +18,10 @@
 import collections
 import os
 from os import path
+from typing import Any
 from absl import flags
 import flax
+from flax.training import checkpoints
 import jax
 import jax.numpy as jnp
 import jax.scipy as jsp
@@ -35,6 +37,7 @@ INTERNAL = False
 @flax.struct.dataclass
 class TrainState:
   optimizer: flax.optim.Optimizer
+  density_grid: Any = None  # Occupancy grid of density estimates, if used.
 
 
 @flax.struct.dataclass
@@ -131,6 +134,27 @@ def define_flags():
       "legacy_posenc_order", False,
       "If True, revert the positional encoding feature order to an older version of this codebase."
   )
+  flags.DEFINE_integer(
+      "occupancy_grid_res", 0,
+      "resolution of the occupancy grid used to skip empty space when "
+      "sampling along rays, 0 disables the grid.")
+  flags.DEFINE_float(
+      "occupancy_bound", 1.5,
+      "the occupancy grid covers the cube [-bound, bound]^3, points outside of "
+      "it are always treated as occupied.")
+  flags.DEFINE_float("occupancy_threshold", 0.01,
+                     "the density above which a grid cell is occupied.")
+  flags.DEFINE_integer(
+      "occupancy_max_samples", 32,
+      "the maximum number of occupied coarse samples per ray evaluated by the "
+      "coarse MLP, at most num_coarse_samples.")
+  flags.DEFINE_integer(
+      "occupancy_update_every", 16,
+      "the number of steps between updates of the occupancy grid.")
+  flags.DEFINE_enum(
+      "mlp_dtype", "float32", ["float32", "bfloat16"],
+      "dtype of the MLP activations and matmuls, the parameters and the "
+      "optimizer state are always kept in float32.")
 
   # Train Flags
   flags.DEFINE_float("lr_init", 5e-4, "The initial learning rate.")
@@ -148,6 +172,10 @@ def define_flags():
 
   flags.DEFINE_integer("max_steps", 1000000,
                        "the number of optimization steps.")
+  flags.DEFINE_integer(
+      "steps_per_call", 1,
+      "the number of optimization steps run back to back on device per call "
+      "from python, every *_every flag and max_steps must be a multiple of it.")
   flags.DEFINE_integer("save_every", 10000,
                        "the number of steps to save a checkpoint.")
   flags.DEFINE_integer("print_every", 100,
@@ -208,6 +236,64 @@ def makedirs(pth):
     os.makedirs(pth)
 
 
+def init_density_grid(args):
+  """Create the initial (fully occupied) density grid, or None if disabled."""
+  if args.occupancy_grid_res <= 0:
+    return None
+  # Start slightly above the threshold so that every cell is occupied until it
+  # has been queried a few times.
+  return jnp.full([args.occupancy_grid_res] * 3, 2. * args.occupancy_threshold)
+
+
+def restore_checkpoint(ckpt_dir, state):
+  """Restore `state` from the latest checkpoint in `ckpt_dir`, if there is one.
+
+  Checkpoints written without a density grid (either before it was added to
+  `TrainState`, or with the grid disabled) keep the grid of `state`.
+
+  Args:
+    ckpt_dir: str, the directory holding the checkpoints.
+    state: TrainState, the target to restore into.
+
+  Returns:
+    state: TrainState, the restored state, or `state` if there is no checkpoint.
+  """
+  state_dict = checkpoints.restore_checkpoint(ckpt_dir, None)
+  if state_dict is None:
+    return state
+  if state_dict.get("density_grid") is None:
+    state_dict["density_grid"] = flax.serialization.to_state_dict(
+        state.density_grid)
+  return flax.serialization.from_state_dict(state, state_dict)
+
+
+def initialize_compilation_cache(train_dir):
+  """Persist compiled XLA executables under `train_dir` across restarts.
+
+  This is a no-op (with a message) on JAX versions without a persistent
+  compilation cache.
+  """
+  cache_dir = path.join(train_dir, "jax_cache")
+  try:
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+  except AttributeError:
+    # Older versions of JAX only expose the (since deprecated) explicit API.
+    try:
+      from jax.experimental.compilation_cache import compilation_cache  # pylint: disable=g-import-not-at-top
+      compilation_cache.initialize_cache(cache_dir)
+    except (ImportError, AttributeError):
+      print("This version of JAX has no persistent compilation cache, "
+            "compiling from scratch.")
+      return
+  # Only available (and needed) on more recent versions of JAX.
+  for name, value in (("jax_persistent_cache_min_entry_size_bytes", 0),
+                      ("jax_persistent_cache_min_compile_time_secs", 1)):
+    try:
+      jax.config.update(name, value)
+    except AttributeError:
+      pass
+
+
 def render_image(render_fn, rays, rng, normalize_disp, chunk=8192):
   """Render all the pixels of an image (in test mode).
 
@@ -229,18 +315,18 @@ def render_image(render_fn, rays, rng, normalize_disp, chunk=8192):
 
   unused_rng, key_0, key_1 = jax.random.split(rng, 3)
   host_id = jax.host_id()
+  # Every chunk, including the final (shorter) one, is padded to the same size
+  # (a multiple of the device count) so that `render_fn` is only compiled once.
+  padded_chunk = -(-chunk // jax.device_count()) * jax.device_count()
   results = []
   for i in range(0, num_rays, chunk):
     # pylint: disable=cell-var-from-loop
     chunk_rays = namedtuple_map(lambda r: r[i:i + chunk], rays)
     chunk_size = chunk_rays[0].shape[0]
-    rays_remaining = chunk_size % jax.device_count()
-    if rays_remaining != 0:
-      padding = jax.device_count() - rays_remaining
+    padding = padded_chunk - chunk_size
+    if padding > 0:
       chunk_rays = namedtuple_map(
           lambda r: jnp.pad(r, ((0, padding), (0, 0)), mode="edge"), chunk_rays)
-    else:
-      padding = 0
     # After padding the number of chunk_rays is always divisible by
     # host_count.
     rays_per_host = chunk_rays[0].shape[0] // jax.host_count()
@@ -395,6 +481,17 @@ def shard(xs):
       lambda x: x.reshape((jax.local_device_count(), -1) + x.shape[1:]), xs)
 
 
+def stack_batches(iterator, num_batches):
+  """Group every `num_batches` sharded batches along a new axis 1."""
+  while True:
+    if num_batches == 1:
+      # Add the axis as a view rather than copying the batch.
+      yield jax.tree_map(lambda x: x[:, None], next(iterator))
+    else:
+      batches = [next(iterator) for _ in range(num_batches)]
+      yield jax.tree_map(lambda *x: np.stack(x, axis=1), *batches)
+
+
 def to_device(xs):
   """Transfer data to devices (GPU/TPU)."""
   return jax.tree_map(jnp.array, xs)
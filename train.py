@@ -16,6 +16,7 @@
 # Lint as: python3
 """Training script for Nerf."""
 
+import concurrent.futures
 import functools
 import gc
 import time
@@ -31,6 +32,7 @@ import jax.numpy as jnp
 import numpy as np
 
 from jaxnerf.nerf import datasets
+from jaxnerf.nerf import model_utils
 from jaxnerf.nerf import models
 from jaxnerf.nerf import utils
 
@@ -40,12 +42,13 @@ utils.define_flags()
 config.parse_flags_with_absl()
 
 
-def train_step(model, rng, state, batch, lr):
+def train_step(model, keys, state, batch, lr):
   """One optimization step.
 
   Args:
     model: The linen model.
-    rng: jnp.ndarray, random number generator.
+    keys: jnp.ndarray, [2, 2], the random number generators for the coarse and
+      fine model sampling, split on the host.
     state: utils.TrainState, state of the model/optimizer.
     batch: dict, a mini-batch of data for training.
     lr: float, real-time learning rate.
@@ -53,13 +56,13 @@ def train_step(model, rng, state, batch, lr):
   Returns:
     new_state: utils.TrainState, new training state.
     stats: list. [(loss, psnr), (loss_coarse, psnr_coarse)].
-    rng: jnp.ndarray, updated random number generator.
   """
-  rng, key_0, key_1 = random.split(rng, 3)
+  key_0, key_1 = keys[0], keys[1]
 
   def loss_fn(variables):
     rays = batch["rays"]
-    ret = model.apply(variables, key_0, key_1, rays, FLAGS.randomized)
+    ret = model.apply(variables, key_0, key_1, rays, FLAGS.randomized,
+                      state.density_grid)
     if len(ret) not in (1, 2):
       raise ValueError(
           "ret should contain either 1 set of output (coarse only), or 2 sets"
@@ -110,7 +113,59 @@ def train_step(model, rng, state, batch, lr):
 
   new_optimizer = state.optimizer.apply_gradient(grad, learning_rate=lr)
   new_state = state.replace(optimizer=new_optimizer)
-  return new_state, stats, rng
+  return new_state, stats
+
+
+def train_steps(model, keys, state, batches, lrs, stats_sum):
+  """Several optimization steps, run back to back on device with lax.scan.
+
+  Args:
+    model: The linen model.
+    keys: jnp.ndarray, [num_steps, 2, 2], the sampling keys of every step.
+    state: utils.TrainState, state of the model/optimizer.
+    batches: dict, the mini-batches of every step, stacked along axis 0.
+    lrs: jnp.ndarray, [num_steps], the learning rate of every step.
+    stats_sum: utils.Stats, the running sum of the stats of previous steps.
+
+  Returns:
+    new_state: utils.TrainState, new training state.
+    stats: utils.Stats, the stats of the last step.
+    stats_sum: utils.Stats, `stats_sum` plus the stats of all the steps.
+  """
+
+  def scan_fn(state, inputs):
+    step_keys, batch, lr = inputs
+    return train_step(model, step_keys, state, batch, lr)
+
+  new_state, stats = jax.lax.scan(scan_fn, state, (keys, batches, lrs))
+  return (new_state, jax.tree_map(lambda x: x[-1], stats),
+          jax.tree_map(lambda s, x: s + x.sum(axis=0), stats_sum, stats))
+
+
+def update_grid_step(model, key, state):
+  """Refresh a random subset of the cells of the occupancy grid.
+
+  Args:
+    model: The linen model.
+    key: jnp.ndarray, random number generator, identical across devices so
+      that they query disjoint shards of the same cells.
+    state: utils.TrainState, state of the model/optimizer.
+
+  Returns:
+    new_state: utils.TrainState, state with the updated density grid.
+  """
+  # Every device queries as many points as the coarse model sees in a training
+  # step.
+  num_cells = FLAGS.batch_size * FLAGS.num_coarse_samples
+  density_grid = model_utils.update_density_grid(
+      key,
+      functools.partial(models.query_density, model, state.optimizer.target),
+      state.density_grid,
+      FLAGS.occupancy_bound,
+      num_cells,
+      axis_name="batch",
+  )
+  return state.replace(density_grid=density_grid)
 
 
 def main(unused_argv):
@@ -127,13 +182,22 @@ def main(unused_argv):
     raise ValueError("train_dir must be set. None set now.")
   if FLAGS.data_dir is None:
     raise ValueError("data_dir must be set. None set now.")
+  aligned_flags = ["max_steps", "save_every", "print_every", "render_every",
+                   "gc_every"]
+  if FLAGS.occupancy_grid_res > 0:
+    aligned_flags.append("occupancy_update_every")
+  for name in aligned_flags:
+    if getattr(FLAGS, name) % FLAGS.steps_per_call != 0:
+      raise ValueError(f"{name} must be divisible by steps_per_call.")
+  utils.initialize_compilation_cache(FLAGS.train_dir)
   dataset = datasets.get_dataset("train", FLAGS)
   test_dataset = datasets.get_dataset("test", FLAGS)
 
   rng, key = random.split(rng)
   model, variables = models.get_model(key, dataset.peek(), FLAGS)
   optimizer = flax.optim.Adam(FLAGS.lr_init).create(variables)
-  state = utils.TrainState(optimizer=optimizer)
+  state = utils.TrainState(
+      optimizer=optimizer, density_grid=utils.init_density_grid(FLAGS))
   del optimizer, variables
 
   learning_rate_fn = functools.partial(
@@ -144,21 +208,38 @@ def main(unused_argv):
       lr_delay_steps=FLAGS.lr_delay_steps,
       lr_delay_mult=FLAGS.lr_delay_mult)
 
-  train_pstep = jax.pmap(
-      functools.partial(train_step, model),
+  train_psteps = jax.pmap(
+      functools.partial(train_steps, model),
       axis_name="batch",
-      in_axes=(0, 0, 0, None),
-      donate_argnums=(2,))
+      in_axes=(0, 0, 0, None, 0),
+      donate_argnums=(1, 2, 4))
+
+  # Running sums of the training stats are kept on device, accumulated by the
+  # train step itself, and only fetched to the host every `print_every` steps.
+  def zero_stats():
+    return flax.jax_utils.replicate(
+        jax.tree_map(np.float32,
+                     utils.Stats(loss=0., psnr=0., loss_c=0., psnr_c=0.,
+                                 weight_l2=0.)))
+
+  update_grid_pstep = jax.pmap(
+      functools.partial(update_grid_step, model),
+      axis_name="batch",
+      in_axes=(None, 0),
+      donate_argnums=(1,))
 
-  def render_fn(variables, key_0, key_1, rays):
+  def render_fn(variables, density_grid, key_0, key_1, rays):
     return jax.lax.all_gather(
-        model.apply(variables, key_0, key_1, rays, FLAGS.randomized),
+        model.apply(variables, key_0, key_1, rays, FLAGS.randomized,
+                    density_grid),
         axis_name="batch")
 
+  # The variables and density grid are already replicated across devices, so
+  # they are mapped as is instead of being broadcast from the host.
   render_pfn = jax.pmap(
       render_fn,
-      in_axes=(None, None, None, 0),  # Only distribute the data input.
-      donate_argnums=(3,),
+      in_axes=(0, 0, None, None, 0),
+      donate_argnums=(4,),
       axis_name="batch",
   )
 
@@ -168,30 +249,61 @@ def main(unused_argv):
 
   if not utils.isdir(FLAGS.train_dir):
     utils.makedirs(FLAGS.train_dir)
-  state = checkpoints.restore_checkpoint(FLAGS.train_dir, state)
+  state = utils.restore_checkpoint(FLAGS.train_dir, state)
   # Resume training a the step of the last checkpoint.
   init_step = state.optimizer.state.step + 1
+  if (init_step - 1) % FLAGS.steps_per_call != 0:
+    raise ValueError(
+        f"The checkpoint at step {init_step - 1} is not aligned with "
+        f"steps_per_call={FLAGS.steps_per_call}.")
   state = flax.jax_utils.replicate(state)
 
   if jax.host_id() == 0:
     summary_writer = tensorboard.SummaryWriter(FLAGS.train_dir)
 
-  # Prefetch_buffer_size = 3 x batch_size
-  pdataset = flax.jax_utils.prefetch_to_device(dataset, 3)
+  # Prefetch_buffer_size = 6 x steps_per_call x batch_size
+  pdataset = flax.jax_utils.prefetch_to_device(
+      utils.stack_batches(dataset, FLAGS.steps_per_call), 6)
   n_local_deices = jax.local_device_count()
+  # The occupancy grid must be updated identically on every host.
+  rng, grid_rng = random.split(rng)
   rng = rng + jax.host_id()  # Make random seed separate across hosts.
-  keys = random.split(rng, n_local_deices)  # For pmapping RNG keys.
+
+  # Split the per-device, per-step (coarse, fine) sampling keys in a single
+  # dispatch compiled to the CPU, so no key work is queued on the devices.
+  def split_keys(rng):
+    rng, key = random.split(rng)
+    keys = random.split(key, n_local_deices * FLAGS.steps_per_call * 2)
+    return rng, keys.reshape((n_local_deices, FLAGS.steps_per_call, 2, -1))
+
+  split_keys_fn = jax.jit(split_keys, backend="cpu")
+
   gc.disable()  # Disable automatic garbage collection for efficiency.
-  stats_trace = []
+  # Checkpoints are written to disk in the background, one at a time.
+  checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  checkpoint_future = None
+  stats_sum, num_stats = zero_stats(), 0
   reset_timer = True
-  for step, batch in zip(range(init_step, FLAGS.max_steps + 1), pdataset):
+  # Every iteration runs the `steps_per_call` steps ending at `step`.
+  for step, batches in zip(
+      range(init_step + FLAGS.steps_per_call - 1, FLAGS.max_steps + 1,
+            FLAGS.steps_per_call), pdataset):
     if reset_timer:
       t_loop_start = time.time()
       reset_timer = False
-    lr = learning_rate_fn(step)
-    state, stats, keys = train_pstep(keys, state, batch, lr)
-    if jax.host_id() == 0:
-      stats_trace.append(stats)
+    lrs = np.array([
+        learning_rate_fn(s)
+        for s in range(step - FLAGS.steps_per_call + 1, step + 1)
+    ], dtype=np.float32)
+    lr = lrs[-1]
+    rng, keys = split_keys_fn(rng)
+    state, stats, stats_sum = train_psteps(keys, state, batches, lrs,
+                                           stats_sum)
+    if (FLAGS.occupancy_grid_res > 0 and
+        step % FLAGS.occupancy_update_every == 0):
+      grid_rng, key = random.split(grid_rng)
+      state = update_grid_pstep(key, state)
+    num_stats += FLAGS.steps_per_call
     if step % FLAGS.gc_every == 0:
       gc.collect()
 
@@ -205,9 +317,9 @@ def main(unused_argv):
         summary_writer.scalar("train_loss_coarse", stats.loss_c[0], step)
         summary_writer.scalar("train_psnr_coarse", stats.psnr_c[0], step)
         summary_writer.scalar("weight_l2", stats.weight_l2[0], step)
-        avg_loss = np.mean(np.concatenate([s.loss for s in stats_trace]))
-        avg_psnr = np.mean(np.concatenate([s.psnr for s in stats_trace]))
-        stats_trace = []
+        avg_stats = jax.tree_map(lambda x: np.mean(x) / num_stats,
+                                 jax.device_get(stats_sum))
+        avg_loss, avg_psnr = avg_stats.loss, avg_stats.psnr
         summary_writer.scalar("train_avg_loss", avg_loss, step)
         summary_writer.scalar("train_avg_psnr", avg_psnr, step)
         summary_writer.scalar("learning_rate", lr, step)
@@ -223,9 +335,20 @@ def main(unused_argv):
               f"weight_l2={stats.weight_l2[0]:0.2e}, " + f"lr={lr:0.2e}, " +
               f"{rays_per_sec:0.0f} rays/sec")
       if step % FLAGS.save_every == 0:
+        # Copy the state to the host now, as its device buffers are donated to
+        # the next training step.
         state_to_save = jax.device_get(jax.tree_map(lambda x: x[0], state))
-        checkpoints.save_checkpoint(
-            FLAGS.train_dir, state_to_save, int(step), keep=100)
+        if checkpoint_future is not None:
+          checkpoint_future.result()  # Surface errors from the previous save.
+        checkpoint_future = checkpoint_executor.submit(
+            checkpoints.save_checkpoint,
+            FLAGS.train_dir,
+            state_to_save,
+            int(step),
+            keep=100)
+
+    if step % FLAGS.print_every == 0:
+      stats_sum, num_stats = zero_stats(), 0
 
     # Test-set evaluation.
     if FLAGS.render_every > 0 and step % FLAGS.render_every == 0:
@@ -233,13 +356,12 @@ def main(unused_argv):
       # here on purpose so that the visualization matches what happened in
       # training.
       t_eval_start = time.time()
-      eval_variables = jax.device_get(jax.tree_map(lambda x: x[0],
-                                                   state)).optimizer.target
       test_case = next(test_dataset)
       pred_color, pred_disp, pred_acc = utils.render_image(
-          functools.partial(render_pfn, eval_variables),
+          functools.partial(render_pfn, state.optimizer.target,
+                            state.density_grid),
           test_case["rays"],
-          keys[0],
+          keys[0, -1, 0],
           FLAGS.dataset == "llff",
           chunk=FLAGS.chunk)
 
@@ -260,6 +382,9 @@ def main(unused_argv):
         summary_writer.image("test_pred_acc", pred_acc, step)
         summary_writer.image("test_target", test_case["pixels"], step)
 
+  if checkpoint_future is not None:
+    checkpoint_future.result()
+  checkpoint_executor.shutdown()
   if FLAGS.max_steps % FLAGS.save_every != 0:
     state = jax.device_get(jax.tree_map(lambda x: x[0], state))
     checkpoints.save_checkpoint(